@@ -1,14 +1,42 @@
+import asyncio
 import datetime
 import logging.config
 from environs import Env
 from seller import download_stock
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from seller import divide, price_conversion
 
 logger = logging.getLogger(__file__)
 
+# Общая сессия для запросов к API Яндекс.Маркета: соединения
+# переиспользуются, временные ошибки повторяются с задержкой.
+session = requests.Session()
+session.headers.update(
+    {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Host": "api.partner.market.yandex.ru",
+    }
+)
+session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "PUT", "POST"],
+            raise_on_status=False,
+        ),
+    ),
+)
+
 
 def get_product_list(page, campaign_id, access_token):
     """Получить список товаров из Яндекс.Маркета.
@@ -33,20 +61,15 @@ def get_product_list(page, campaign_id, access_token):
         requests.exceptions.HTTPError: 401 Client Error: Unauthorized
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {
         "page_token": page,
         "limit": 200,
     }
     url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
+    response = session.get(url, headers=headers, params=payload)
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object.get("result")
 
 
@@ -76,17 +99,12 @@ def update_stocks(stocks, campaign_id, access_token):
         requests.exceptions.HTTPError: 401 Client Error: Unauthorized
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {"skus": stocks}
     url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
+    response = session.put(url, headers=headers, data=orjson.dumps(payload))
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object
 
 
@@ -113,17 +131,12 @@ def update_price(prices, campaign_id, access_token):
         requests.exceptions.HTTPError: 401 Client Error: Unauthorized
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {"offers": prices}
     url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
+    response = session.post(url, headers=headers, data=orjson.dumps(payload))
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object
 
 
@@ -135,12 +148,12 @@ def get_offer_ids(campaign_id, market_token):
         market_token (str): Токен доступа для авторизации.
 
     Returns:
-        list: Список артикулов товаров.
+        set: Множество артикулов товаров.
 
     Examples:
         Корректное использование:
         >>> get_offer_ids("123456", "your_access_token")
-        ['SKU123', 'SKU456']
+        {'SKU123', 'SKU456'}
 
         Некорректное использование:
         >>> get_offer_ids("123456", "invalid_token")
@@ -156,10 +169,7 @@ def get_offer_ids(campaign_id, market_token):
         page = some_prod.get("paging").get("nextPageToken")
         if not page:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
-    return offer_ids
+    return {product.get("offer").get("shopSku") for product in product_list}
 
 
 def create_stocks(watch_remnants, offer_ids, warehouse_id):
@@ -167,7 +177,7 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
 
     Args:
         watch_remnants (list): Данные о остатках товаров.
-        offer_ids (list): Список артикулов товаров.
+        offer_ids (set): Множество артикулов товаров.
         warehouse_id (str): Идентификатор склада.
 
     Returns:
@@ -175,28 +185,30 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
 
     Examples:
         Корректное использование:
-        >>> create_stocks([{'Код': 'SKU123', 'Количество': '5'}], ['SKU123'], '1')
+        >>> create_stocks([{'Код': 'SKU123', 'Количество': '5'}], {'SKU123'}, '1')
         [{'sku': 'SKU123', 'warehouseId': '1', 'items': [{'count': 5, 'type': 'FIT', 'updatedAt': '2024-01-01T00:00:00Z'}]}]
 
         Некорректное использование:
-        >>> create_stocks([], [], '1')
+        >>> create_stocks([], set(), '1')
         []
     """
     # Уберем то, что не загружено в market
     stocks = list()
     date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
+    matched = set()
     for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
+        code = str(watch.get("Код"))
+        if code in offer_ids and code not in matched:
             count = str(watch.get("Количество"))
             if count == ">10":
                 stock = 100
             elif count == "1":
                 stock = 0
             else:
-                stock = int(watch.get("Количество"))
+                stock = int(count)
             stocks.append(
                 {
-                    "sku": str(watch.get("Код")),
+                    "sku": code,
                     "warehouseId": warehouse_id,
                     "items": [
                         {
@@ -207,9 +219,9 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
                     ],
                 }
             )
-            offer_ids.remove(str(watch.get("Код")))
+            matched.add(code)
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
+    for offer_id in offer_ids - matched:
         stocks.append(
             {
                 "sku": offer_id,
@@ -231,25 +243,26 @@ def create_prices(watch_remnants, offer_ids):
 
     Args:
         watch_remnants (list): Данные о ценах товаров.
-        offer_ids (list): Список артикулов товаров.
+        offer_ids (set): Множество артикулов товаров.
 
     Returns:
         list: Список цен для обновления.
 
     Examples:
         Корректное использование:
-        >>> create_prices([{'Код': 'SKU123', 'Цена': '1000'}], ['SKU123'])
+        >>> create_prices([{'Код': 'SKU123', 'Цена': '1000'}], {'SKU123'})
         [{'id': 'SKU123', 'price': {'value': 1000, 'currencyId': 'RUR'}}]
 
         Некорректное использование:
-        >>> create_prices([], [])
+        >>> create_prices([], set())
         []
     """
     prices = []
     for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
+        code = str(watch.get("Код"))
+        if code in offer_ids:
             price = {
-                "id": str(watch.get("Код")),
+                "id": code,
                 # "feed": {"id": 0},
                 "price": {
                     "value": int(price_conversion(watch.get("Цена"))),
@@ -264,11 +277,12 @@ def create_prices(watch_remnants, offer_ids):
     return prices
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(watch_remnants, offer_ids, campaign_id, market_token):
     """Загрузить обновленные цены на Яндекс.Маркет.
 
     Args:
         watch_remnants (list): Данные о ценах товаров.
+        offer_ids (set): Множество артикулов из get_offer_ids.
         campaign_id (str): Идентификатор кампании в Яндекс.Маркете.
         market_token (str): Токен доступа для авторизации.
 
@@ -277,27 +291,29 @@ async def upload_prices(watch_remnants, campaign_id, market_token):
 
     Examples:
         Корректное использование:
-        >>> await upload_prices([{'Код': 'SKU123', 'Цена': '1000'}], "123456", "your_access_token")
+        >>> await upload_prices([{'Код': 'SKU123', 'Цена': '1000'}], {'SKU123'}, "123456", "your_access_token")
         {'result': 'success'}
 
         Некорректное использование:
-        >>> await upload_prices([], "123456", "invalid_token")
+        >>> await upload_prices([], {'SKU123'}, "123456", "invalid_token")
         Traceback (most recent call last):
             ...
         requests.exceptions.HTTPError: 401 Client Error: Unauthorized
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
+    for some_prices in divide(prices, 500):
         update_price(some_prices, campaign_id, market_token)
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(
+    watch_remnants, offer_ids, campaign_id, market_token, warehouse_id
+):
     """Загрузить остатки товаров на Яндекс.Маркет.
 
     Args:
         watch_remnants (list): Данные о остатках товаров.
+        offer_ids (set): Множество артикулов из get_offer_ids.
         campaign_id (str): Идентификатор кампании в Яндекс.Маркете.
         market_token (str): Токен доступа для авторизации.
         warehouse_id (str): Идентификатор склада.
@@ -307,22 +323,19 @@ async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id)
 
     Examples:
         Корректное использование:
-        >>> await upload_stocks([{'Код': 'SKU123', 'Количество': '10'}], "123456", "your_access_token", "1")
+        >>> await upload_stocks([{'Код': 'SKU123', 'Количество': '10'}], {'SKU123'}, "123456", "your_access_token", "1")
         ([{'sku': 'SKU123', 'warehouseId': '1', 'items': [{'count': 10, 'type': 'FIT', 'updatedAt': ...}}]], [{'sku': 'SKU123', 'warehouseId': '1', 'items': [{'count': 10, 'type': 'FIT', 'updatedAt': ...}}]])
 
         Некорректное использование:
-        >>> await upload_stocks([], "123456", "invalid_token", "1")
+        >>> await upload_stocks([], {'SKU123'}, "123456", "invalid_token", "1")
         Traceback (most recent call last):
             ...
         requests.exceptions.HTTPError: 401 Client Error: Unauthorized
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
     stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
+    for some_stock in divide(stocks, 2000):
         update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
-    )
+    not_empty = [stock for stock in stocks if stock["items"][0]["count"] != 0]
     return not_empty, stocks
 
 
@@ -353,19 +366,27 @@ def main():
         offer_ids = get_offer_ids(campaign_fbs_id, market_token)
         # Обновить остатки FBS
         stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
+        for some_stock in divide(stocks, 2000):
             update_stocks(some_stock, campaign_fbs_id, market_token)
         # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
+        asyncio.run(
+            upload_prices(
+                watch_remnants, offer_ids, campaign_fbs_id, market_token
+            )
+        )
 
         # DBS
         offer_ids = get_offer_ids(campaign_dbs_id, market_token)
         # Обновить остатки DBS
         stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
+        for some_stock in divide(stocks, 2000):
             update_stocks(some_stock, campaign_dbs_id, market_token)
         # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
+        asyncio.run(
+            upload_prices(
+                watch_remnants, offer_ids, campaign_dbs_id, market_token
+            )
+        )
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
@@ -1,43 +1,93 @@
-import io
+import asyncio
 import logging.config
-import os
-import re
+import tempfile
 import zipfile
 from environs import Env
 
+import aiohttp
+import numpy as np
+import orjson
 import pandas as pd
 import requests
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+try:
+    import uvloop
+except ImportError:  # uvloop не поддерживает Windows
+    uvloop = None
 
 logger = logging.getLogger(__file__)
 
+# Ограничение одновременных запросов к API Ozon
+MAX_CONCURRENT_REQUESTS = 8
+# Коды ответа API, при которых запрос стоит повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
-def get_product_list(last_id, client_id, seller_token):
+
+def is_transient_error(error: BaseException) -> bool:
+    """Проверить, что ошибку запроса можно устранить повтором.
+
+    Args:
+        error (BaseException): Исключение, возникшее при запросе.
+
+    Returns:
+        bool: True для ошибок соединения, таймаутов и ответов из
+        RETRY_STATUSES. Ошибки авторизации (401, 403) не повторяются.
+
+    Examples:
+        Корректное использование:
+        >>> is_transient_error(asyncio.TimeoutError())
+        True
+
+        Некорректное использование:
+        >>> is_transient_error(ValueError())
+        False
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    return isinstance(
+        error, (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+    )
+
+
+# Повтор запросов к API с экспоненциальной задержкой и случайным разбросом
+api_retry = retry(
+    retry=retry_if_exception(is_transient_error),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+
+
+@api_retry
+async def get_product_list(last_id, session):
     """Получить список товаров магазина Ozon.
 
     Args:
         last_id (str): Последний идентификатор товара.
-        client_id (str): Идентификатор клиента.
-        seller_token (str): Токен для доступа к API продавца.
+        session (aiohttp.ClientSession): Сессия с заголовками авторизации
+            продавца.
 
     Returns:
         dict: Словарь с результатами запроса.
 
     Examples:
         Корректное использование:
-        >>> get_product_list("3", "12345", "asda23sad")
+        >>> await get_product_list("3", session)
         {'items': [...], 'total': 100}
 
         Некорректное использование:
-        >>> get_product_list("3", "12345", "invalid_seller_token")
+        >>> await get_product_list("3", invalid_session)
         Traceback (most recent call last):
             ...
-        requests.exceptions.HTTPError: 401 Client Error: Unauthorized
+        aiohttp.client_exceptions.ClientResponseError: 401, message='Unauthorized'
     """
     url = "https://api-seller.ozon.ru/v2/product/list"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
     payload = {
         "filter": {
             "visibility": "ALL",
@@ -45,114 +95,184 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    response_object = response.json()
+    async with session.post(url, data=orjson.dumps(payload)) as response:
+        response.raise_for_status()
+        response_object = await response.json(loads=orjson.loads)
     return response_object.get("result")
 
 
-def get_offer_ids(client_id, seller_token):
+async def get_offer_ids(session):
     """Получить артикулы товаров магазина Ozon.
 
     Args:
-        client_id (str): Идентификатор клиента.
-        seller_token (str): Токен для доступа к API продавца.
+        session (aiohttp.ClientSession): Сессия с заголовками авторизации
+            продавца.
 
     Returns:
-        list: Список артикулов товаров.
+        set: Множество артикулов товаров.
 
     Examples:
         Корректное использование:
-        >>> get_offer_ids("12345", "valid_seller_token")
-        ['offer1', 'offer2', ...]
+        >>> await get_offer_ids(session)
+        {'offer1', 'offer2', ...}
 
         Некорректное использование:
-        >>> get_offer_ids("12345", "invalid_seller_token")
+        >>> await get_offer_ids(invalid_session)
         Traceback (most recent call last):
             ...
-        requests.exceptions.HTTPError: 401 Client Error: Unauthorized
+        aiohttp.client_exceptions.ClientResponseError: 401, message='Unauthorized'
     """
-    last_id = ""
-    product_list = []
-    while True:
-        some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
+    offer_ids = set()
+    received = 0
+    next_page = asyncio.create_task(get_product_list("", session))
+    while next_page:
+        some_prod = await next_page
+        items = some_prod.get("items")
         total = some_prod.get("total")
-        last_id = some_prod.get("last_id")
-        if total == len(product_list):
-            break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
+        received += len(items)
+        # Запросить следующую страницу, пока разбираем текущую
+        if items and received < total:
+            last_id = some_prod.get("last_id")
+            next_page = asyncio.create_task(get_product_list(last_id, session))
+        else:
+            next_page = None
+        offer_ids.update({product.get("offer_id") for product in items})
     return offer_ids
 
 
-def update_price(prices: list, client_id, seller_token):
+@api_retry
+async def update_price(prices: list, session):
     """Обновить цены товаров.
 
     Args:
         prices (list): Список цен, которые нужно обновить.
-        client_id (str): Идентификатор клиента.
-        seller_token (ster): Токен для доступа к API продавца.
+        session (aiohttp.ClientSession): Сессия с заголовками авторизации
+            продавца.
 
     Returns:
         dict: Результат запроса обновления цен.
 
     Examples:
         Корректное использование:
-        >>> update_price([{'offer_id': '123', 'price': '5990'}], "12345",
-                        "valid_seller_token")
+        >>> await update_price([{'offer_id': '123', 'price': '5990'}], session)
         {'status': 'success'}
 
         Некорректное использование:
-        >>> update_price([], "12345", "invalid_seller_token")
+        >>> await update_price([], invalid_session)
         Traceback (most recent call last):
             ...
-        requests.exceptions.HTTPError: 401 Client Error: Unauthorized
+        aiohttp.client_exceptions.ClientResponseError: 401, message='Unauthorized'
     """
     url = "https://api-seller.ozon.ru/v1/product/import/prices"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    async with session.post(url, data=orjson.dumps(payload)) as response:
+        response.raise_for_status()
+        return await response.json(loads=orjson.loads)
 
 
-def update_stocks(stocks: list, client_id, seller_token):
+@api_retry
+async def update_stocks(stocks: list, session):
     """Обновить остатки товаров.
 
     Args:
         stocks (list): Список остатков для обновления.
-        client_id: Идентификатор клиента.
-        seller_token: Токен для доступа к API продавца.
+        session (aiohttp.ClientSession): Сессия с заголовками авторизации
+            продавца.
 
     Returns:
         dict: Результат запроса обновления остатков.
 
     Examples:
         Корректное использование:
-        >>> update_stocks([{'offer_id': '123', 'stock': 10}], "12345",
-                         "valid_seller_token")
+        >>> await update_stocks([{'offer_id': '123', 'stock': 10}], session)
         {'status': 'success'}
 
         Некорректное использование:
-        >>> update_stocks([], "12345", "invalid_seller_token")
+        >>> await update_stocks([], invalid_session)
         Traceback (most recent call last):
             ...
-        requests.exceptions.HTTPError: 401 Client Error: Unauthorized
+        aiohttp.client_exceptions.ClientResponseError: 401, message='Unauthorized'
     """
     url = "https://api-seller.ozon.ru/v1/product/import/stocks"
+    payload = {"stocks": stocks}
+    async with session.post(url, data=orjson.dumps(payload)) as response:
+        response.raise_for_status()
+        return await response.json(loads=orjson.loads)
+
+
+def create_session(client_id, seller_token):
+    """Создать HTTP-сессию для запросов к API продавца Ozon.
+
+    Заголовки авторизации задаются один раз, соединения переиспользуются
+    всеми запросами сессии.
+
+    Args:
+        client_id (str): Идентификатор клиента.
+        seller_token (str): Токен для доступа к API продавца.
+
+    Returns:
+        aiohttp.ClientSession: Сессия, которую нужно закрыть после работы.
+
+    Examples:
+        Корректное использование:
+        >>> async with create_session("12345", "valid_seller_token") as session:
+        ...     await get_offer_ids(session)
+        {'offer1', 'offer2', ...}
+    """
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
-    payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return aiohttp.ClientSession(headers=headers)
+
+
+def download_stock_table():
+    """Скачать файл остатков с сайта Casio и прочитать его в таблицу.
+
+    Returns:
+        pandas.DataFrame: Таблица остатков товаров.
+
+    Examples:
+        Корректное использование:
+        >>> download_stock_table()
+             Код Количество   Цена
+        0    123         10   5990
+        ...
+
+        Некорректное использование:
+        >>> download_stock_table()
+        Traceback (most recent call last):
+            ...
+        requests.exceptions.HTTPError: 404 Client Error: Not Found
+    """
+    # Скачать остатки с сайта
+    casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
+    session = requests.Session()
+    # Архив до 32 МБ держим в памяти, больший сбрасывается во временный файл
+    with tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024) as buffer:
+        with session.get(casio_url, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                buffer.write(chunk)
+        buffer.seek(0)
+        # Создаем таблицу остатков часов прямо из архива:
+        with zipfile.ZipFile(buffer) as archive:
+            with archive.open("ostatki.xls") as excel_file:
+                watch_table = pd.read_excel(
+                    io=excel_file,
+                    na_values=None,
+                    keep_default_na=False,
+                    header=17,
+                    usecols=["Код", "Количество", "Цена"],
+                    dtype={
+                        "Код": "string",
+                        "Количество": "string",
+                        "Цена": "string",
+                    },
+                    engine="calamine",
+                )
+    return watch_table
 
 
 def download_stock():
@@ -172,23 +292,7 @@ def download_stock():
             ...
         requests.exceptions.HTTPError: 404 Client Error: Not Found
     """
-    # Скачать остатки с сайта
-    casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
-    response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
-    return watch_remnants
+    return download_stock_table().to_dict(orient="records")
 
 
 def create_stocks(watch_remnants, offer_ids):
@@ -196,37 +300,39 @@ def create_stocks(watch_remnants, offer_ids):
 
     Args:
         watch_remnants (list): Список остатков, загруженных из файла.
-        offer_ids (list): Список артикулов, загруженных в Ozon.
+        offer_ids (set): Множество артикулов, загруженных в Ozon.
 
     Returns:
         list: Список остатков для обновления.
 
     Examples:
         Корректное использование:
-        >>> create_stocks(watch_remnants, ['offer1', 'offer2'])
+        >>> create_stocks(watch_remnants, {'offer1', 'offer2'})
         [{'offer_id': 'offer1', 'stock': 10}, ...]
 
         Некорректное использование:
-        >>> create_stocks(None, ['offer1', 'offer2'])
+        >>> create_stocks(None, {'offer1', 'offer2'})
         Traceback (most recent call last):
             ...
         AttributeError: 'NoneType' object has no attribute 'get'
     """
     # Уберем то, что не загружено в seller
     stocks = []
+    matched = set()
     for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
+        code = str(watch.get("Код"))
+        if code in offer_ids and code not in matched:
             count = str(watch.get("Количество"))
             if count == ">10":
                 stock = 100
             elif count == "1":
                 stock = 0
             else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
+                stock = int(count)
+            stocks.append({"offer_id": code, "stock": stock})
+            matched.add(code)
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
+    for offer_id in offer_ids - matched:
         stocks.append({"offer_id": offer_id, "stock": 0})
     return stocks
 
@@ -236,29 +342,30 @@ def create_prices(watch_remnants, offer_ids):
 
     Args:
         watch_remnants (list): Список остатков, загруженных из файла.
-        offer_ids (list): Список артикулов, загруженных в Ozon.
+        offer_ids (set): Множество артикулов, загруженных в Ozon.
 
     Returns:
         list: Список цен для обновления
 
     Examples:
         Корректное использование:
-        >>> create_prices(watch_remnants, ['offer1', 'offer2'])
+        >>> create_prices(watch_remnants, {'offer1', 'offer2'})
         [{'offer_id': 'offer1', 'price': '5990'}, ...]
 
         Некорректное использование:
-        >>> create_prices(None, ['offer1', 'offer2'])
+        >>> create_prices(None, {'offer1', 'offer2'})
         Traceback (most recent call last):
             ...
         AttributeError: 'NoneType' object has no attribute 'get'
     """
     prices = []
     for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
+        code = str(watch.get("Код"))
+        if code in offer_ids:
             price = {
                 "auto_action_enabled": "UNKNOWN",
                 "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
+                "offer_id": code,
                 "old_price": "0",
                 "price": price_conversion(watch.get("Цена")),
             }
@@ -266,6 +373,91 @@ def create_prices(watch_remnants, offer_ids):
     return prices
 
 
+def create_stocks_and_prices(watch_table, offer_ids):
+    """Создать списки остатков и цен по таблице остатков.
+
+    Таблица индексируется по коду, и для каждого артикула нужная строка
+    находится по индексу. Остатки и цены вычисляются по столбцам целиком,
+    без цикла по строкам.
+
+    Args:
+        watch_table (pandas.DataFrame): Таблица остатков, загруженная из
+            файла.
+        offer_ids (set): Множество артикулов, загруженных в Ozon.
+
+    Returns:
+        tuple: Кортеж с двумя списками:
+            - Список остатков для обновления, как в create_stocks.
+            - Список цен для обновления, как в create_prices.
+
+    Examples:
+        Корректное использование:
+        >>> create_stocks_and_prices(watch_table, {'offer1', 'offer2'})
+        ([{'offer_id': 'offer1', 'stock': 10}, ...], [{'offer_id': 'offer1', 'price': '5990', ...}, ...])
+
+        Некорректное использование:
+        >>> create_stocks_and_prices(None, {'offer1', 'offer2'})
+        Traceback (most recent call last):
+            ...
+        TypeError: 'NoneType' object is not subscriptable
+    """
+    # Строка таблицы на каждый артикул Ozon, найденная по коду. У артикулов,
+    # которых нет в файле, значения пустые.
+    table = (
+        watch_table.assign(offer_id=watch_table["Код"].astype(str))
+        .drop_duplicates("offer_id")
+        .set_index("offer_id")
+        .reindex(pd.Index(list(offer_ids), name="offer_id"))
+    )
+    found = table["Код"].notna()
+    count = table["Количество"].fillna("0").astype(str)
+    stock = np.where(
+        count == ">10",
+        100,
+        np.where(
+            count == "1",
+            0,
+            pd.to_numeric(count, errors="coerce").fillna(0).astype(int),
+        ),
+    )
+    price = (
+        table.loc[found, "Цена"]
+        .astype(str)
+        .str.split(".", n=1)
+        .str[0]
+        .str.translate(DIGITS_ONLY)
+    )
+    stocks = pd.DataFrame(
+        {"offer_id": table.index, "stock": stock}
+    ).to_dict(orient="records")
+    prices = price.rename("price").reset_index().assign(
+        auto_action_enabled="UNKNOWN",
+        currency_code="RUB",
+        old_price="0",
+    ).to_dict(orient="records")
+    return stocks, prices
+
+
+class DigitsTable(dict):
+    """Таблица для str.translate, удаляющая все символы, кроме цифр 0-9.
+
+    Удаляемые символы запоминаются при первом обращении, поэтому повторная
+    очистка похожих строк не вызывает __missing__.
+
+    Examples:
+        Корректное использование:
+        >>> "5'990 руб".translate(DIGITS_ONLY)
+        '5990'
+    """
+
+    def __missing__(self, key):
+        self[key] = None
+        return None
+
+
+DIGITS_ONLY = DigitsTable({ord(digit): ord(digit) for digit in "0123456789"})
+
+
 # Преобразует строку с нечисловыми символами в числовую строку. Строка с
 # ценой, которая может содержать нечисловые символы, пробелы или разделители
 # разрядов.
@@ -291,12 +483,15 @@ def price_conversion(price: str) -> str:
             ...
         AttributeError: 'NoneType' object has no attribute 'split'
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    return price.split(".", 1)[0].translate(DIGITS_ONLY)
 
 
 def divide(lst: list, n: int):
     """Разделить список lst на части по n элементов.
 
+    Части создаются по одной, по мере перебора. Каждая часть — срез списка:
+    копируются только ссылки на элементы, сами элементы не копируются.
+
     Args:
         lst (list): Исходный список.
         n (int): Размер каждой части.
@@ -320,42 +515,68 @@ def divide(lst: list, n: int):
         yield lst[i: i + n]
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+async def send_batches(update, items: list, n: int, session):
+    """Отправить список частями по n элементов параллельно.
+
+    Одновременно выполняется не больше MAX_CONCURRENT_REQUESTS запросов.
+
+    Args:
+        update: Корутина отправки одной части, например update_price.
+        items (list): Список цен или остатков.
+        n (int): Размер каждой части.
+        session: Сессия с заголовками авторизации продавца.
+
+    Returns:
+        list: Ответы сервера по каждой части в исходном порядке.
+
+    Examples:
+        Корректное использование:
+        >>> await send_batches(update_price, prices, 1000, session)
+        [{'result': [...]}, ...]
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def send(batch):
+        async with semaphore:
+            return await update(batch, session)
+
+    return await asyncio.gather(*[send(batch) for batch in divide(items, n)])
+
+
+async def upload_prices(watch_remnants, offer_ids, session):
     """Загрузить цены товаров в Ozon.
 
     Args:
         watch_remnants: Список остатков, загруженных из файла.
-        client_id: Идентификатор клиента.
-        seller_token: Токен для доступа к API продавца.
+        offer_ids: Множество артикулов из get_offer_ids.
+        session: Сессия с заголовками авторизации продавца.
 
     Returns:
         list: Список всех обновленных цен.
 
     Examples:
         Корректное использование:
-        >>> await upload_prices(watch_remnants, "12345", "valid_seller_token")
+        >>> await upload_prices(watch_remnants, offer_ids, session)
         [{'offer_id': 'offer1', 'price': '5990'}, ...]
 
         Некорректное использование:
-        >>> await upload_prices(None, "12345", "invalid_seller_token")
+        >>> await upload_prices(None, offer_ids, session)
         Traceback (most recent call last):
             ...
         TypeError: 'NoneType' object has no attribute 'get'
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    await send_batches(update_price, prices, 1000, session)
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(watch_remnants, offer_ids, session):
     """Загрузить остатки товаров в Ozon.
 
     Args:
         watch_remnants: Список остатков, загруженных из файла.
-        client_id: Идентификатор клиента.
-        seller_token: Токен для доступа к API продавца.
+        offer_ids: Множество артикулов из get_offer_ids.
+        session: Сессия с заголовками авторизации продавца.
 
     Returns:
         tuple: Кортеж с двумя списками:
@@ -364,23 +585,42 @@ async def upload_stocks(watch_remnants, client_id, seller_token):
 
     Examples:
         Корректное использование:
-        >>> await upload_stocks(watch_remnants, "12345", "valid_seller_token")
+        >>> await upload_stocks(watch_remnants, offer_ids, session)
         ([{'offer_id': 'offer1', 'stock': 10}, ...], [{'offer_id': 'offer1', 'stock': 10}, ...])
 
         Некорректное использование:
-        >>> await upload_stocks(None, "12345", "invalid_seller_token")
+        >>> await upload_stocks(None, offer_ids, session)
         Traceback (most recent call last):
             ...
         AttributeError: 'NoneType' object has no attribute 'get'
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
     stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    await send_batches(update_stocks, stocks, 100, session)
+    not_empty = [stock for stock in stocks if stock["stock"] != 0]
     return not_empty, stocks
 
 
+async def amain(client_id, seller_token):
+    """Загрузить остатки и цены товаров в Ozon через одну HTTP-сессию.
+
+    Args:
+        client_id (str): Идентификатор клиента.
+        seller_token (str): Токен для доступа к API продавца.
+
+    Examples:
+        Корректное использование:
+        >>> asyncio.run(amain("12345", "valid_seller_token"))
+    """
+    async with create_session(client_id, seller_token) as session:
+        offer_ids = await get_offer_ids(session)
+        watch_table = download_stock_table()
+        stocks, prices = create_stocks_and_prices(watch_table, offer_ids)
+        # Обновить остатки
+        await send_batches(update_stocks, stocks, 100, session)
+        # Поменять цены
+        await send_batches(update_price, prices, 900, session)
+
+
 def main():
     """Основная функция для загрузки остатков и цен товаров в Ozon.
 
@@ -398,19 +638,15 @@ def main():
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
-        watch_remnants = download_stock()
-        # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
-        # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
-    except requests.exceptions.ReadTimeout:
+        # Цикл событий uvloop быстрее стандартного, если он установлен
+        run = uvloop.run if uvloop else asyncio.run
+        run(amain(client_id, seller_token))
+    except (requests.exceptions.ReadTimeout, asyncio.TimeoutError):
         print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
+    except (
+        requests.exceptions.ConnectionError,
+        aiohttp.ClientConnectionError,
+    ) as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")